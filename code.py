@@ -10,10 +10,12 @@
 # - https://docs.circuitpython.org/en/latest/shared-bindings/ulab/index.html
 # - https://docs.circuitpython.org/en/latest/shared-bindings/ulab/numpy/index.html
 # - https://numpy.org/doc/stable/reference/generated/numpy.zeros.html
+# - https://docs.circuitpython.org/en/latest/shared-bindings/bitmaptools/index.html
 #
 from binascii import b2a_base64
+from bitmaptools import arrayblit
 from board import STEMMA_I2C
-from displayio import Bitmap, Palette
+from displayio import Bitmap
 from gc import collect, mem_free
 from sys import stdout
 from time import sleep
@@ -24,6 +26,24 @@ from adafruit_seesaw import digitalio
 from adafruit_seesaw.seesaw import Seesaw
 
 
+# Frame size (160x128px matches Adafruit PyGamer). The Bitmap in main() has 11
+# possible values, so it stores 4 bits per pixel.
+_W = 160
+_H = 128
+_FRAME_BYTES = _W * _H // 2
+
+# Preallocated buffer for sendPalette() so knob turns don't allocate a new
+# buffer for the rotated colors (sendSmall() still allocates its output)
+_PAL_BUF = bytearray(48)    # rotated RGB colors
+
+# Preallocated output buffer for send(), big enough for the base64 lines of a
+# frame plus the BEGIN and END marker lines. This lets send() gather a frame
+# for one USB CDC write, but it saves write calls, not heap: send() still
+# allocates about 14KB of base64 lines per frame on top of this buffer.
+_OUT = bytearray(
+    64 + ((_FRAME_BYTES + 2) // 3) * 4 + (_FRAME_BYTES + 56) // 57)
+
+
 def gcCol():
     # Collect garbage and print free memory
     collect()
@@ -34,71 +54,99 @@ def send(buf, tag):
     # Performance Notes: Caching function references as local vars is a
     # MicroPython speedup trick that avoids repeated dictionary lookups. Also,
     # using sys.stdout.write() here is *way* faster than using print().
-    wr = stdout.write
+    # Slicing a memoryview avoids copying each chunk before encoding it, and
+    # gathering all the lines in _OUT allows for just one USB CDC write.
+    # Encoding Notes: base85 would be about 6% smaller than base64, but
+    # CircuitPython's binascii has no base85 encoder. Doing it in Python
+    # would cost more time than the smaller output saves because each 32-bit
+    # word needs several divisions, and words over 2**30 allocate long ints.
     b64 = b2a_base64
-    wr('\n-----BEGIN %s-----\n' % tag)
-    stride = 60
-    last = 0
-    for i in range(0, len(buf), stride):
-        wr(b64(buf[i:i+stride]))
-        last = i
-    if i + stride < len(buf):
-        wr(b64(buf[i+stride:]))
-    wr('-----END %s-----\n' % tag)
+    mv = memoryview(buf)
+    assert len(mv) <= _FRAME_BYTES, 'buffer too big to send'
+    out = _OUT
+    s = ('\n-----BEGIN %s-----\n' % tag).encode()
+    j = len(s)
+    out[0:j] = s
+    # 57 bytes of input encodes to a standard 76 character base64 line
+    stride = 57
+    for i in range(0, len(mv), stride):
+        s = b64(mv[i:i+stride])
+        k = j + len(s)
+        out[j:k] = s
+        j = k
+    s = ('-----END %s-----\n' % tag).encode()
+    k = j + len(s)
+    out[j:k] = s
+    stdout.write(memoryview(out)[:k])
+
+def sendSmall(buf, tag):
+    # Send a short buffer (at most 57 bytes) as a single line of base64. This
+    # skips the chunking loop of send() for the palette, which gets sent for
+    # every knob turn.
+    assert len(buf) <= 57, 'buffer too big for sendSmall()'
+    stdout.write('\n-----BEGIN %s-----\n%s-----END %s-----\n'
+        % (tag, b2a_base64(buf).decode(), tag))
 
 def sendPalette(pal, angle):
-    # Send color palette with red and white rotated by angle
+    # Send color palette with red and white rotated by angle. The palette is
+    # 48 bytes of packed RGB colors, so rotating colors 4..11 takes just a
+    # couple of byte slice copies rather than a Python loop. Slicing a
+    # memoryview avoids copying each slice into a temporary bytes object.
     assert ((0 <= angle) and (angle <= 7)), 'angle out of range'
-    n = len(pal)
-    assert n == 16, 'unexpected palette size'
-    start = 4 + angle
-    end = 12
-    data = bytearray(n * 3)
-    # Make a list of the new order of colors after rotating red and white
-    order = ([0, 1, 2, 3]
-        + list(range(start, end)) + list(range(4, start)) + [12, 13, 14, 15])
-    # Make a buffer of colors in the rotated order (use big-endian byte order)
-    for i in range(n):
-        c = pal[order[i]]
-        m = i * 3
-        data[m]   = (c >> 16) & 255
-        data[m+1] = (c >>  8) & 255
-        data[m+2] =  c        & 255
-    send(data, 'PALETTE')
+    assert len(pal) == 48, 'unexpected palette size'
+    pal = memoryview(pal)
+    out = _PAL_BUF
+    s = (4 + angle) * 3     # offset of first color after rotation
+    e = 36 - (angle * 3)    # offset where the wrapped colors begin
+    out[0:12] = pal[0:12]
+    out[12:e] = pal[s:36]
+    out[e:36] = pal[12:s]
+    out[36:48] = pal[36:48]
+    sendSmall(out, 'PALETTE')
 
 def initPalette():
-    # Return the initial color palette
-    p = Palette(16)
-    p[ 0] = 0xaaaaaa  # gray
-    p[ 1] = 0x666666  # dark gray
-    p[ 2] = 0xaa00aa  # purple
-    p[ 3] = 0x660066  # dark purple
-    p[ 4] = 0xffffff  # white
-    p[ 5] = 0xf7f7f7
-    p[ 6] = 0xefefef
-    p[ 7] = 0xe7e7e7
-    p[ 8] = 0xff0000  # red
-    p[ 9] = 0xf70000
-    p[10] = 0xef0000
-    p[11] = 0xe70000
-    p[12] = 0xff00ff  # magenta
-    p[13] = 0xff00ff
-    p[14] = 0xff00ff
-    p[15] = 0xff00ff
-    return p
+    # Return the initial color palette as 48 bytes of big-endian RGB colors
+    return bytes((
+        0xaa, 0xaa, 0xaa,  # gray
+        0x66, 0x66, 0x66,  # dark gray
+        0xaa, 0x00, 0xaa,  # purple
+        0x66, 0x00, 0x66,  # dark purple
+        0xff, 0xff, 0xff,  # white
+        0xf7, 0xf7, 0xf7,
+        0xef, 0xef, 0xef,
+        0xe7, 0xe7, 0xe7,
+        0xff, 0x00, 0x00,  # red
+        0xf7, 0x00, 0x00,
+        0xef, 0x00, 0x00,
+        0xe7, 0x00, 0x00,
+        0xff, 0x00, 0xff,  # magenta
+        0xff, 0x00, 0xff,
+        0xff, 0x00, 0xff,
+        0xff, 0x00, 0xff,
+    ))
 
 def paint(bitmap, w, h):
-    # Paint frame with a color cycleable red and white checkerboard pattern
-    for y in range(h):
-        for x in range(w):
-            angle = (x >> 2) & 3
-            grid = ((y >> 4) & 1) ^ ((x >> 4) & 1)   # checkerboard pattern
-            if x >= 48 and x < 96 and y >= 32 and y < 80:
-                bitmap[x,y] = 4 + (grid * 4) + angle
-            elif x & 15 == 0 or y & 15 == 0:
-                bitmap[x,y] = 1
-            else:
-                bitmap[x,y] = 0
+    # Paint frame with a color cycleable red and white checkerboard pattern.
+    # This uses ulab array operations because a per-pixel Python loop over
+    # 160x128 pixels is very slow. To avoid needing a big contiguous block of
+    # heap, which can fail once memory gets fragmented, pixels get painted in
+    # 16px tall strips that reuse one small buffer.
+    assert h % 16 == 0, 'height must be a multiple of 16'
+    strip = np.zeros((16, w), dtype=np.uint8)
+    xs = np.arange(48, 96, dtype=np.uint8)
+    angle = (xs >> 2) & 3
+    for y in range(0, h, 16):
+        strip[:, :] = 0
+        strip[0, :] = 1         # horizontal grid line
+        strip[:, ::16] = 1      # vertical grid lines
+        # Strips line up with the 16px checkerboard squares, so each strip is
+        # either fully inside or fully outside the box rows (32..79), and all
+        # its rows share the same value of (y >> 4) & 1
+        if y >= 32 and y < 80:
+            grid = ((xs >> 4) & 1) ^ ((y >> 4) & 1)   # checkerboard pattern
+            strip[:, 48:96] = (grid << 2) + angle + 4
+        # Copy pixels into the bitmap (arrayblit packs them as 4-bit values)
+        arrayblit(bitmap, strip, 0, y, w, y + 16)
 
 def drainCDCBuf():
     # Drain the serial console buffer.
@@ -113,13 +161,14 @@ def main():
     # Initialize stuff then start event loop
     drainCDCBuf()   # usb_cdc.console may have leftover garbage
     gcCol()
-    # Make frame buffer (160x128px size matches Adafruit PyGamer)
-    w = 160
-    h = 128
+    # Make frame buffer
+    w = _W
+    h = _H
     bitmap = Bitmap(w, h, 11)    # 11 = number of possible values
-    pal = initPalette()          # color palette (RGBA 32 bits each)
+    pal = initPalette()          # color palette (16 RGB colors, 48 bytes)
     gcCol()
     buf = np.frombuffer(bitmap, dtype=np.uint8)
+    assert len(buf) == _FRAME_BYTES, 'unexpected frame buffer size'
     paint(bitmap, w, h)          # draw a pattern
     gcCol()
     # Set up rotary encoder
@@ -131,13 +180,21 @@ def main():
     ssw.pin_mode(24, Seesaw.INPUT_PULLUP)
     # Cache function references to speed up the main loop
     #  delta: encoder position delta
-    #  click: true when encoder knob button (seesaw pin 24) is pressed
+    #  dr:    seesaw digital read (knob button on pin 24 is low when pressed)
     #  pr:    fast print to stdout
-    #  gcc:   collect garbage
+    #  col:   collect garbage (without gcCol's mem_free print)
+    #  slp:   sleep
+    #  snd:   send a frame
+    #  sndP:  send a palette
+    #  drain: drain serial console input buffer
     delta = ssw.encoder_delta
-    click = lambda: not ssw.digital_read(24)
+    dr = ssw.digital_read
     pr = stdout.write
-    col = gcCol
+    col = collect
+    slp = sleep
+    snd = send
+    sndP = sendPalette
+    drain = drainCDCBuf
     # SEND COLOR PALETTE AND FIRST FRAME
     print('display size', w, h)
     print('bits per pixel', bitmap.bits_per_value)
@@ -146,16 +203,33 @@ def main():
     prevClick = False
     fullFrameDirty = False
     paletteDirty = False
+    gcTicks = 0
+    idleTicks = 0
     while True:
-        sleep(0.005)
+        # Poll quickly while the knob is in use, but back off to a slower rate
+        # after about 100ms of no activity to save I2C traffic and CPU time
+        slp(0.05 if idleTicks > 20 else 0.005)
+        # Collect garbage every 256 loops rather than after every event, since
+        # a collection scans the whole heap. Sending a frame leaves about 14KB
+        # of garbage (a new base64 bytes object for each 57 byte stride), but
+        # that's fine because MicroPython collects automatically whenever an
+        # allocation would otherwise fail.
+        gcTicks = (gcTicks + 1) & 255
+        if gcTicks == 0:
+            col()
         # Check for newline wake sequence on the serial console
         cons = usb_cdc.console
         if cons and cons.in_waiting > 0:
             # for any console input (probably LF) -> send full frame
-            drainCDCBuf()
+            drain()
             fullFrameDirty = True
         # Read the rotary encoder (Seesaw I2C)
-        (c, d) = (click(), delta())
+        (c, d) = (not dr(24), delta())
+        if c == prevClick and d == 0:
+            if idleTicks <= 20:
+                idleTicks += 1
+        else:
+            idleTicks = 0
         if c and (c != prevClick):
             # knob was clicked -> send full frame
             fullFrameDirty = True
@@ -165,14 +239,12 @@ def main():
             angle = (32 + angle + d) & 7       # update angle, modulo 8
             paletteDirty = True
         if fullFrameDirty:
-            send(buf, 'FRAME')
-            sendPalette(pal, angle)
+            snd(buf, 'FRAME')
+            sndP(pal, angle)
             fullFrameDirty = False
             paletteDirty = False
-            col()
         if paletteDirty:
-            sendPalette(pal, angle)
+            sndP(pal, angle)
             paletteDirty = False
-            col()
 
 main()